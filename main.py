@@ -3,14 +3,16 @@ import logging
 import os
 import re
 import time
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 from urllib.parse import urljoin
 from zoneinfo import ZoneInfo
 
+import aiofiles
 import aiohttp
-from bs4 import BeautifulSoup
-from icalendar import Calendar, Event
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+from lxml import etree, html
 
 logging.basicConfig(
     level=logging.INFO,
@@ -18,213 +20,321 @@ logging.basicConfig(
     handlers=[logging.FileHandler("scraper.log"), logging.StreamHandler()],
 )
 
+_HTTP_CACHE_PATH = ".http_cache.sqlite"
+
+_DATE_RE = re.compile(r"(\d{2})\.(\d{2})\.")
+_DURATION_RE = re.compile(r"(\d+)\s*Min\.")
+_FSK_RE = re.compile(r"FSK:\s*(\d+)")
+
+_COMPONENT_XP = etree.XPath("(//*[@id='sp-component'])[1]")
+_REDUCED_COL_XP = etree.XPath(
+    ".//div[contains(concat(' ', @class, ' '), ' cal-data-reduced ')]"
+    "//div[contains(concat(' ', @class, ' '), ' col ')]"
+)
+_DESC_XP = etree.XPath("string(.//div//ul/li[4])")
+_DURATION_FSK_XP = etree.XPath("string(.//div//ul/li[2])")
+_ROOM_XP = etree.XPath(
+    "string(.//div[contains(concat(' ', @class, ' '), ' cal-data-performance ')]"
+    "//div[not(preceding-sibling::*)]//span[count(preceding-sibling::*) = 2])"
+)
+_TRAILER_XP = etree.XPath("string(//iframe[contains(@src, 'youtube.com')]/@src)")
+_TABLE_XP = etree.XPath("//table[contains(concat(' ', @class, ' '), ' table-text ')]")
+
+_ICS_HEADER = (
+    "BEGIN:VCALENDAR\r\n"
+    "VERSION:2.0\r\n"
+    "PRODID:-//Kino Dießen Movie Schedule//diessen.de//\r\n"
+)
+_ICS_FOOTER = "END:VCALENDAR\r\n"
+_ICS_EVENT_TEMPLATE = (
+    "BEGIN:VEVENT\r\n"
+    "{summary}\r\n"
+    "DTSTART:{dtstart}\r\n"
+    "DTEND:{dtend}\r\n"
+    "{description}\r\n"
+    "{location}\r\n"
+    "END:VEVENT\r\n"
+)
+_ICS_ESCAPE = str.maketrans(
+    {"\\": "\\\\", ";": "\\;", ",": "\\,", "\n": "\\n", "\r": None}
+)
+_ICS_LINE_LIMIT = 75
+
+
+def _ics_line(name: str, value: str) -> str:
+    line = f"{name}:{value.translate(_ICS_ESCAPE)}"
+    if line.isascii():
+        step = _ICS_LINE_LIMIT - 1
+        return "\r\n ".join(line[i : i + step] for i in range(0, len(line), step))
+
+    chars = []
+    size = 0
+    for char in line:
+        char_size = len(char.encode("utf-8"))
+        size += char_size
+        if size >= _ICS_LINE_LIMIT:
+            chars.append("\r\n ")
+            size = char_size
+        chars.append(char)
+    return "".join(chars)
+
+
+def _parse_html(page: bytes, charset: Optional[str]) -> html.HtmlElement:
+    if charset is None:
+        try:
+            page.decode("utf-8")
+            charset = "utf-8"
+        except UnicodeDecodeError:
+            pass
+
+    try:
+        parser = html.HTMLParser(encoding=charset) if charset else None
+        return html.fromstring(page, parser=parser)
+    except (LookupError, ValueError, etree.ParserError):
+        page = page.decode("utf-8", errors="replace").encode("utf-8")
+        return html.fromstring(page, parser=html.HTMLParser(encoding="utf-8"))
+
+
+@dataclass(slots=True)
+class MovieDetails:
+    duration: int = 120
+    description: str = ""
+    trailer: str = ""
+    fsk: str = ""
+    room: str = ""
+
+
+@dataclass(slots=True)
+class ParsedRow:
+    title: str
+    url: str
+    cells: List[html.HtmlElement]
+
 
 class FastMovieScraper:
     def __init__(self, base_url="https://www.kino-diessen.de", max_concurrent=50):
         self.base_url = base_url
+        self.schedule_url = f"{base_url}/im-kino-offcanvas/kinoprogramm/"
         self.location = "Kinowelt am Ammersee\nFischerei 12\n86911 Dießen am Ammersee"
+        self._location_ics = _ics_line("LOCATION", self.location)
         self.session: Optional[aiohttp.ClientSession] = None
-        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.max_concurrent = max_concurrent
+        self._details_cache: Dict[str, Optional[MovieDetails]] = {}
+        self._inflight: Dict[str, asyncio.Event] = {}
 
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession()
+        connector = aiohttp.TCPConnector(
+            limit=self.max_concurrent,
+            limit_per_host=16,
+            ttl_dns_cache=300,
+            keepalive_timeout=30,
+        )
+        cache = SQLiteBackend(
+            _HTTP_CACHE_PATH,
+            expire_after=7 * 86400,
+            cache_control=True,
+        )
+        self.session = CachedSession(
+            cache=cache,
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
         return self
 
     async def __aexit__(self, *exc):
         await self.session.close()
 
     @staticmethod
-    def _create_event_description(movie_details: Dict, booking_url: str) -> str:
-        description_lines = [
-            movie_details.get("description", ""),
-            "",
-            f"🕐 Dauer: {movie_details.get('duration', 120)} Minuten",
-            f"🔞 FSK: {movie_details.get('fsk', '')}"
-            if movie_details.get("fsk")
-            else None,
-            f"🏛️ Saal: {movie_details.get('room', '')}"
-            if movie_details.get("room")
-            else None,
-            "",
-            f"🎬 Trailer: {movie_details.get('trailer', '')}"
-            if movie_details.get("trailer")
-            else None,
-            "",
-            f"🎟️ Tickets: {booking_url}",
-        ]
-        return "\n\n".join(filter(None, description_lines))
-
-    async def get_movie_details(self, url: str, movie_title: str) -> Dict:
-        async with self.semaphore:
-            try:
-                async with self.session.get(urljoin(self.base_url, url)) as response:
+    def _create_event_description(details: MovieDetails, booking_url: str) -> str:
+        parts = [details.description] if details.description else []
+        parts.append(f"🕐 Dauer: {details.duration} Minuten")
+        if details.fsk:
+            parts.append(f"🔞 FSK: {details.fsk}")
+        if details.room:
+            parts.append(f"🏛️ Saal: {details.room}")
+        if details.trailer:
+            parts.append(f"🎬 Trailer: {details.trailer}")
+        parts.append(f"🎟️ Tickets: {booking_url}")
+        return "\n\n".join(parts)
+
+    async def _fetch(
+        self,
+        url: str,
+        retries: int = 3,
+        refresh: bool = False,
+        expire_after: Optional[int] = None,
+    ) -> Tuple[bytes, Optional[str]]:
+        for attempt in range(retries):
+            async with self.session.get(
+                url, refresh=refresh, expire_after=expire_after
+            ) as response:
+                if response.status < 500 or attempt == retries - 1:
                     response.raise_for_status()
-                    html = await response.text()
-                    soup = BeautifulSoup(html, "html.parser")
-
-                    details = {
-                        "duration": 120,
-                        "description": "",
-                        "trailer": "",
-                        "fsk": "",
-                        "room": "",
-                    }
-
-                    desc_elem = soup.select_one(
-                        "#sp-component div.cal-data-reduced div.col div ul li:nth-child(4)"
-                    )
-                    details["description"] = desc_elem.text.strip() if desc_elem else ""
+                    return await response.read(), response.charset
+            logging.warning(f"Server error {response.status} for {url}, retrying")
+            await asyncio.sleep(2**attempt)
 
-                    duration_elem = soup.select_one(
-                        "#sp-component div.cal-data-reduced div.col div ul li:nth-child(2)"
-                    )
-                    if duration_elem:
-                        text = duration_elem.text.strip()
-                        duration_match = re.search(r"(\d+)\s*Min\.", text)
-                        details["duration"] = (
-                            int(duration_match.group(1)) if duration_match else 120
-                        )
-
-                        fsk_match = re.search(r"FSK:\s*(\d+)", text)
-                        details["fsk"] = fsk_match.group(1) if fsk_match else ""
-
-                    room_elem = soup.select_one(
-                        "#sp-component div.cal-data-performance div:nth-child(1) span:nth-child(3)"
-                    )
-                    details["room"] = room_elem.text.strip() if room_elem else ""
+    @staticmethod
+    def _parse_movie_details(page: bytes, charset: Optional[str]) -> MovieDetails:
+        tree = _parse_html(page, charset)
+        component = next(iter(_COMPONENT_XP(tree)), None)
+        if component is None:
+            return MovieDetails(trailer=_TRAILER_XP(tree))
+
+        cols = _REDUCED_COL_XP(component)
+        text = next(filter(None, (_DURATION_FSK_XP(col) for col in cols)), "")
+        duration_match = _DURATION_RE.search(text)
+        fsk_match = _FSK_RE.search(text)
+
+        return MovieDetails(
+            duration=int(duration_match.group(1)) if duration_match else 120,
+            description=next(filter(None, (_DESC_XP(col).strip() for col in cols)), ""),
+            trailer=_TRAILER_XP(tree),
+            fsk=fsk_match.group(1) if fsk_match else "",
+            room=_ROOM_XP(component).strip(),
+        )
 
-                    trailer_elem = soup.find(
-                        "iframe", src=lambda s: s and "youtube.com" in s
-                    )
-                    details["trailer"] = trailer_elem["src"] if trailer_elem else ""
+    async def get_movie_details(
+        self, url: str, movie_title: str
+    ) -> Optional[MovieDetails]:
+        if url in self._details_cache:
+            return self._details_cache[url]
+        if url in self._inflight:
+            await self._inflight[url].wait()
+            return self._details_cache.get(url)
+
+        self._inflight[url] = asyncio.Event()
+        details = None
+        try:
+            page, charset = await self._fetch(url, refresh=True)
+            details = await asyncio.to_thread(self._parse_movie_details, page, charset)
 
-                    logging.info(f"Processed movie details: {movie_title}")
-                    return details
+            logging.info(f"Processed movie details: {movie_title}")
 
-            except Exception as e:
-                logging.error(f"Error fetching movie details for {movie_title}: {e}")
-                return {}
+        except Exception as e:
+            logging.error(f"Error fetching movie details for {movie_title}: {e}")
+
+        finally:
+            self._details_cache[url] = details
+            self._inflight.pop(url).set()
+
+        return details
 
-    async def scrape_movies(self) -> Optional[Calendar]:
+    async def scrape_movies(self) -> Optional[List[str]]:
         start_time = time.time()
+        current_year = datetime.now().year
         try:
-            async with self.session.get(
-                f"{self.base_url}/im-kino-offcanvas/kinoprogramm/"
-            ) as response:
-                response.raise_for_status()
-                cal = self._prepare_calendar()
+            page, charset = await self._fetch(self.schedule_url, expire_after=600)
+            cal = []
 
-                soup = BeautifulSoup(await response.text(), "html.parser")
-                table = soup.find("table", class_="table-text")
+            tables = _TABLE_XP(_parse_html(page, charset))
+            del page
 
-                if not table:
-                    logging.error("No movie table found")
-                    return None
+            if not tables:
+                logging.error("No movie table found")
+                return None
 
-                dates, movies = self._extract_table_data(table)
-                movie_details = await self._fetch_movie_details(movies)
-                events = await self._generate_movie_events(movies, dates, movie_details)
+            dates, parsed_rows = self._extract_table_data(tables[0], current_year)
+            events = await self._collect_movie_events(parsed_rows, dates)
 
-                self._add_events_to_calendar(cal, events)
+            self._add_events_to_calendar(cal, events)
 
-                end_time = time.time()
-                logging.info(
-                    f"Total scraping time: {end_time - start_time:.2f} seconds"
-                )
-                return cal
+            end_time = time.time()
+            logging.info(f"Total scraping time: {end_time - start_time:.2f} seconds")
+            return cal
 
         except Exception as e:
             logging.error(f"Error scraping movies: {e}")
             return None
 
-    @staticmethod
-    def _prepare_calendar() -> Calendar:
-        cal = Calendar()
-        cal.add("version", "2.0")
-        cal.add("prodid", "-//Kino Dießen Movie Schedule//diessen.de//")
-        return cal
-
-    def _extract_table_data(self, table):
+    def _extract_table_data(self, table, current_year: int):
         dates = [
-            self._parse_date(th.text.strip().replace("\n", ""))
-            for th in table.find("thead").find_all("th")[1:]
+            self._parse_date(th.text_content().strip().replace("\n", ""), current_year)
+            for th in table.find(".//thead").findall(".//th")[1:]
         ]
-        movies = table.find("tbody").find_all("tr")
-        return dates, movies
-
-    async def _fetch_movie_details(self, movies):
-        movie_details_tasks = []
-        for row in movies:
-            movie_link = row.find("a")
-            if movie_link:
-                movie_url = movie_link["href"]
-                movie_title = f"🎬 {movie_link.text.strip()}"
-                movie_details_tasks.append(
-                    self.get_movie_details(movie_url, movie_title)
+        parsed_rows = []
+        for row in table.find(".//tbody").findall(".//tr"):
+            movie_link = row.find(".//a")
+            if movie_link is not None:
+                parsed_rows.append(
+                    ParsedRow(
+                        title=f"🎬 {movie_link.text_content().strip()}",
+                        url=urljoin(self.base_url, movie_link.get("href")),
+                        cells=list(row.iterchildren("td")),
+                    )
                 )
-        return await asyncio.gather(*movie_details_tasks)
+        return dates, parsed_rows
 
-    async def _generate_movie_events(self, movies, dates, movie_details):
-        async def process_movie(row, details):
-            movie_link = row.find("a")
-            if not movie_link or not details:
-                return None
-
-            movie_title = f"🎬 {movie_link.text.strip()}"
-            events = []
-            screenings = row.find_all("td")
+    async def _collect_movie_events(self, parsed_rows: List[ParsedRow], dates):
+        async def fetch(index, pr: ParsedRow):
+            return index, await self.get_movie_details(pr.url, pr.title)
 
-            for date, cell in zip(dates, screenings):
-                for time_link in cell.find_all("a"):
-                    event = self._create_movie_event(
-                        movie_title, date, time_link, details
-                    )
-                    events.append(event)
+        tasks = [
+            asyncio.create_task(fetch(index, pr))
+            for index, pr in enumerate(parsed_rows)
+        ]
+        events = [None] * len(parsed_rows)
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                index, details = await next_done
+                events[index] = list(
+                    self._events_for_row(parsed_rows[index], dates, details)
+                )
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return events
 
-            return events
+    def _events_for_row(self, pr: ParsedRow, dates, details):
+        if details is None:
+            return
 
-        event_tasks = [
-            process_movie(row, details) for row, details in zip(movies, movie_details)
-        ]
-        return await asyncio.gather(*event_tasks)
+        for date, cell in zip(dates, pr.cells):
+            for time_link in cell.iter("a"):
+                yield self._create_movie_event(pr.title, date, time_link, details)
 
     def _create_movie_event(self, movie_title, date, time_link, details):
-        time_text = time_link.find("span").text.strip()
+        time_text = time_link.find(".//span").text_content().strip()
         hour, minute = map(int, time_text.split(":"))
 
-        event = Event()
-        event.add("summary", movie_title)
         start_time = date.replace(hour=hour, minute=minute)
-        event.add("dtstart", start_time)
-        event.add("dtend", start_time + timedelta(minutes=details["duration"]))
-        event.add("location", self.location)
-
-        description = self._create_event_description(details, time_link["href"])
-        event.add("description", description)
-        return event
+        end_time = start_time + timedelta(minutes=details.duration)
+        description = self._create_event_description(details, time_link.get("href"))
+
+        return _ICS_EVENT_TEMPLATE.format(
+            summary=_ics_line("SUMMARY", movie_title),
+            dtstart=start_time.strftime("%Y%m%dT%H%M%S"),
+            dtend=end_time.strftime("%Y%m%dT%H%M%S"),
+            description=_ics_line("DESCRIPTION", description),
+            location=self._location_ics,
+        )
 
     @staticmethod
     def _add_events_to_calendar(cal, results):
         for movie_events in results:
             if movie_events:
-                for event in movie_events:
-                    cal.add_component(event)
+                cal.extend(movie_events)
 
     @staticmethod
-    def _parse_date(date_text: str) -> datetime:
-        match = re.search(r"(\d{2})\.(\d{2})\.", date_text)
+    def _parse_date(date_text: str, current_year: int) -> datetime:
+        match = _DATE_RE.search(date_text)
         return (
-            datetime(datetime.now().year, int(match.group(2)), int(match.group(1)))
+            datetime(current_year, int(match.group(2)), int(match.group(1)))
             if match
             else None
         )
 
-    async def save_calendar(self, cal: Calendar):
+    async def save_calendar(self, cal: List[str]):
         try:
             os.makedirs("docs", exist_ok=True)
 
-            with open("docs/movies.ics", "wb") as f:
-                f.write(cal.to_ical())
+            async with aiofiles.open(
+                "docs/movies.ics", "w", encoding="utf-8", newline=""
+            ) as f:
+                await f.write(_ICS_HEADER)
+                await f.writelines(cal)
+                await f.write(_ICS_FOOTER)
             logging.info("Calendar file saved successfully")
 
             await self._create_html_page()
@@ -255,7 +365,7 @@ class FastMovieScraper:
 async def main():
     async with FastMovieScraper() as scraper:
         cal = await scraper.scrape_movies()
-        if cal:
+        if cal is not None:
             await scraper.save_calendar(cal)
 
 